@@ -0,0 +1,56 @@
+"""Microbenchmark: cost of rendering one alert email.
+
+Usage: python benchmarks/bench_email.py [iterations]
+
+Renders every advisory in benchmarks/corpus/ through the precompiled
+templates and reports the mean cost per email, both for the template
+render alone and for the full MIME message that send_email builds.
+"""
+import os
+import sys
+import time
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import server  # noqa: E402
+from standins import load_corpus  # noqa: E402
+
+CALENDAR_EVENTS = [
+    "Spray a copper-based fungicide within 24 hours",
+    "Scout plants daily for leaf miner galleries (recurring)",
+    "🌾 Daily Crop Monitoring — 21 days recurring",
+]
+
+
+def build_message(text):
+    subject, plain, html = server.render_alert_email("Ali", "Meknes", "tomato", text, CALENDAR_EVENTS)
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = subject
+    msg["From"]    = "advisor@example.com"
+    msg["To"]      = "farmer@example.com"
+    msg.attach(MIMEText(plain, "plain", "utf-8"))
+    msg.attach(MIMEText(html, "html", "utf-8"))
+    return msg.as_string()
+
+
+def bench(label, fn, corpus, iterations):
+    fn(corpus[0])  # warm template and parser caches
+    started = time.perf_counter()
+    for i in range(iterations):
+        fn(corpus[i % len(corpus)])
+    per_email = (time.perf_counter() - started) / iterations
+    print(f"{label:<28} {per_email * 1e6:9.1f} µs/email   {1 / per_email:10.0f} emails/s")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    corpus = load_corpus()
+    print(f"🌾 Email render benchmark — {iterations} iterations over {len(corpus)} advisories")
+    bench("render_alert_email", lambda t: server.render_alert_email("Ali", "Meknes", "tomato", t, CALENDAR_EVENTS),
+          corpus, iterations)
+    bench("render + MIME encode", build_message, corpus, iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Microbenchmarks: advisory parsing and scheduling hot paths.
+
+Usage: python benchmarks/bench_parsing.py [iterations]
+
+Runs extract_actions, format_response_as_html and smart_schedule over every
+advisory in benchmarks/corpus/. "cold" clears the parser and classifier
+memo caches before each call (a never-seen response); "warm" measures the
+memoized path that the calendar, email and /invoke consumers share.
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import server  # noqa: E402
+from standins import load_corpus  # noqa: E402
+
+
+def clear_caches():
+    server.parse_advisory.cache_clear()
+    server.classify_action.cache_clear()
+
+
+def bench(label, fn, inputs, iterations, cold):
+    started = time.perf_counter()
+    for i in range(iterations):
+        if cold:
+            clear_caches()
+        fn(inputs[i % len(inputs)])
+    per_call = (time.perf_counter() - started) / iterations
+    print(f"{label:<38} {per_call * 1e6:9.1f} µs/call")
+
+
+def schedule_all(actions):
+    now   = datetime(2026, 6, 1, 8, 0)
+    slots = server.SlotAllocator()
+    for a in actions:
+        server.smart_schedule(a["description"], a["urgency"], now, slots)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    corpus  = load_corpus()
+    actions = [server.extract_actions(text) for text in corpus]
+    print(f"🌾 Parsing benchmark — {iterations} iterations over {len(corpus)} advisories")
+    for cold in (True, False):
+        mode = "cold" if cold else "warm"
+        bench(f"extract_actions ({mode})", server.extract_actions, corpus, iterations, cold)
+        bench(f"format_response_as_html ({mode})", server.format_response_as_html, corpus, iterations, cold)
+        bench(f"smart_schedule, per advisory ({mode})", schedule_all, actions, iterations, cold)
+
+
+if __name__ == "__main__":
+    main()
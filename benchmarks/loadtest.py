@@ -0,0 +1,210 @@
+"""Reproducible load test for /invoke against local stand-ins.
+
+Usage:
+    python benchmarks/loadtest.py --requests 200 --concurrency 20 \
+        --latency 1.5 --error-rate 0.02 [--mode flask|async] [--stream | --jobs] [--cache] \
+        [--backends 3 --slow-rate 0.05]
+
+Starts a fake agent API, an SMTP sink and a fake Calendar (see standins.py),
+launches server.py in a subprocess wired to them through its environment,
+then drives /invoke at the requested concurrency. Every request uses a
+unique farmer email, so notification completion is timed from the request
+being sent to its email arriving at the sink.
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from standins import FakeAgentAPI, FakeCalendar, SMTPSink
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server.py")
+CROPS  = ["tomato", "wheat", "olive", "potato", "citrus"]
+CITIES = ["Meknes", "Fes", "Ifrane", "Sidi Kacem", "Agadir"]
+STAGES = ["seedling", "vegetative", "flowering", "fruiting"]
+
+
+def build_prompt(i):
+    crop, city, stage = random.choice(CROPS), random.choice(CITIES), random.choice(STAGES)
+    email = f"farmer{i}@loadtest.local"
+    prompt = (
+        f"Hi, I am Farmer {i}, a farmer from {city}. My farm is located at: Plot {i} ({city}).\n\n"
+        f"I grow {crop} and my crops are currently at the {stage} stage. I use drip irrigation. "
+        f"My email is {email}. Use \"{city}\" for the weather lookup. Can you assess the current "
+        f"weather conditions and tell me if my crops are at risk and what I should do to protect them?"
+    )
+    return email, prompt
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def report(label, values, wall):
+    print(f"{label:<26} n={len(values):<5} {len(values) / wall:8.2f}/s   "
+          f"p50={percentile(values, 50):6.3f}s  p95={percentile(values, 95):6.3f}s  "
+          f"p99={percentile(values, 99):6.3f}s")
+
+
+def start_server(args, agents, smtp, calendar, workdir):
+    port = args.port
+    env = dict(
+        os.environ,
+        API_URL=agents[0].url + "/",
+        API_URLS=",".join(a.url + "/" for a in agents),
+        API_KEY="loadtest",
+        PORT=str(port),
+        ASYNC_PORT=str(port),
+        SMTP_HOST="127.0.0.1",
+        SMTP_PORT=str(smtp.port),
+        SMTP_SECURITY="none",
+        GMAIL_USER="advisor@loadtest.local",
+        GMAIL_PASSWORD="",
+        CALENDAR_API_ENDPOINT=calendar.url,
+        CALENDAR_TOKEN_PATH=os.path.join(workdir, "token.json"),
+        CALENDAR_INDEX_PATH=os.path.join(workdir, "calendar_events.db"),
+        NOTIFY_QUEUE_PATH=os.path.join(workdir, "notifications.db"),
+        NOTIFY_QUEUE_MAX=str(max(1000, args.requests * 2)),
+        NOTIFY_COALESCE_WINDOW="0",
+        ADVISORY_CACHE_SIZE="256" if args.cache else "0",
+        UPSTREAM_POOL_SIZE=str(max(20, args.concurrency)),
+        CALENDAR_RATE_LIMIT="0",   # the stand-ins have no quotas to respect
+        SMTP_RATE_LIMIT="0",
+        GEOCODE_BACKEND="standins:FakeGeocodeBackend",
+        GEOCODE_CACHE_PATH=os.path.join(workdir, "geocode.db"),
+        HISTORY_PATH=os.path.join(workdir, "advisory_history.db"),
+        JOBS_PATH=os.path.join(workdir, "advisory_jobs.db"),
+        TRACE_PATH=os.path.join(workdir, "traces.jsonl"),
+        TRACE_SLOW_PATH=os.path.join(workdir, "slow_requests.jsonl"),
+        PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                 os.environ.get("PYTHONPATH")])),
+    )
+    FakeCalendar.write_token(env["CALENDAR_TOKEN_PATH"])
+    cmd = [sys.executable, SERVER] + (["serve-async"] if args.mode == "async" else [])
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen(cmd, env=env, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(base + "/metrics", timeout=1)
+            return proc, base
+        except requests.RequestException:
+            if proc.poll() is not None:
+                raise SystemExit(f"❌ server.py exited early — see {log.name}")
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("❌ server.py did not start within 30s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=1.0, help="mean fake agent latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--backends", type=int, default=1, help="number of fake agent endpoints")
+    parser.add_argument("--slow-rate", type=float, default=0.0,
+                        help="share of agent calls that take 5x the mean latency (a latency tail)")
+    parser.add_argument("--calendar-latency", type=float, default=0.05)
+    parser.add_argument("--mode", choices=["flask", "async"], default="flask")
+    parser.add_argument("--stream", action="store_true", help="use the SSE streaming mode")
+    parser.add_argument("--jobs", action="store_true", help="submit async jobs and long-poll /jobs/<id>")
+    parser.add_argument("--cache", action="store_true", help="leave the advisory cache enabled")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--notify-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    agents   = [FakeAgentAPI(args.latency, args.jitter, args.error_rate, slow_rate=args.slow_rate)
+                for _ in range(args.backends)]
+    smtp     = SMTPSink()
+    calendar = FakeCalendar(args.calendar_latency)
+    workdir  = tempfile.mkdtemp(prefix="crop-loadtest-")
+    proc, base = start_server(args, agents, smtp, calendar, workdir)
+    print(f"🌾 {args.requests} requests, concurrency {args.concurrency}, mode={args.mode}"
+          f"{' +stream' if args.stream else ''}{' +jobs' if args.jobs else ''}{' +cache' if args.cache else ''}, "
+          f"agent latency {args.latency}s ±{args.jitter}, error rate {args.error_rate:.0%}, "
+          f"{args.backends} backend(s), slow rate {args.slow_rate:.0%}")
+
+    local   = threading.local()
+    results = []           # (email, sent_at, latency, status)
+    lock    = threading.Lock()
+
+    def one(i):
+        session = getattr(local, "session", None) or requests.Session()
+        local.session = session
+        email, prompt = build_prompt(i)
+        body = {"input": [{"type": "text", "text": prompt}], "session_id": f"load-{i}"}
+        if args.stream:
+            body["stream"] = True
+        if args.jobs:
+            body["async"] = True
+        sent = time.time()
+        try:
+            r = session.post(base + "/invoke", json=body, timeout=300)
+            r.content  # drain streamed bodies
+            status = r.status_code
+            if status == 202:
+                job = r.json()
+                while job["state"] not in ("done", "failed"):
+                    job = session.get(base + job["status_url"], params={"wait": 30}, timeout=60).json()
+                status = job["status"]
+        except requests.RequestException:
+            status = 0
+        with lock:
+            results.append((email, sent, time.time() - sent, status))
+
+    try:
+        started = time.time()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(one, range(args.requests)))
+        wall = time.time() - started
+
+        ok = [r for r in results if r[3] == 200]
+        expected = {r[0]: r[1] for r in ok}
+        deadline = time.time() + args.notify_timeout
+        while time.time() < deadline and len(set(smtp.delivered_at()) & set(expected)) < len(expected):
+            time.sleep(0.2)
+        delivered = smtp.delivered_at()
+        notify = [delivered[e] - sent for e, sent in expected.items() if e in delivered]
+        notify_wall = (max(delivered[e] for e in expected if e in delivered) - started) if notify else wall
+
+        statuses = {}
+        for r in results:
+            statuses[r[3]] = statuses.get(r[3], 0) + 1
+        print(f"status codes: {dict(sorted(statuses.items()))}   upstream calls: {sum(a.calls for a in agents)}   "
+              f"calendar events: {len(calendar.events)}")
+        report("request (all)", [r[2] for r in results], wall)
+        report("request (200 only)", [r[2] for r in ok], wall)
+        report("notification completion", notify, notify_wall)
+        if len(notify) < len(expected):
+            print(f"⚠️ {len(expected) - len(notify)} notification(s) not delivered within {args.notify_timeout}s")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=args.notify_timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        for s in (*agents, smtp, calendar):
+            s.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
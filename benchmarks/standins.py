@@ -0,0 +1,304 @@
+"""Local stand-ins for the services server.py talks to.
+
+- FakeAgentAPI:  answers /invoke payloads with advisories from the corpus,
+                 with configurable latency, jitter, error rate and a share of
+                 slow (5x latency) calls. Streams SSE when the request sets
+                 "stream": true.
+- SMTPSink:      accepts and records mail; no TLS, no auth.
+- FakeCalendar:  enough of the Calendar v3 REST API for create_calendar_events
+                 (freeBusy, events insert/list and multipart batch requests).
+- FakeGeocodeBackend: in-process geocoder; select it with
+                 GEOCODE_BACKEND=standins:FakeGeocodeBackend.
+
+The network stand-ins each run on a daemon thread bound to 127.0.0.1 on a free port.
+"""
+import json
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+
+
+def load_corpus():
+    corpus = []
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if name.endswith(".txt"):
+            with open(os.path.join(CORPUS_DIR, name), encoding="utf-8") as f:
+                corpus.append(f.read())
+    return corpus
+
+
+class _Server:
+    def __init__(self, server):
+        self.server = server
+        self.port   = server.server_address[1]
+        self.url    = f"http://127.0.0.1:{self.port}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _HangupTolerantServer(ThreadingHTTPServer):
+    """Clients may hang up mid-answer (a hedged request that lost); don't log that."""
+
+    def handle_error(self, request, client_address):
+        if not issubclass(sys.exc_info()[0], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+# ─────────────────────────────────────────────
+# AGENT API
+# ─────────────────────────────────────────────
+class FakeAgentAPI(_Server):
+    def __init__(self, latency=1.0, jitter=0.2, error_rate=0.0, corpus=None, slow_rate=0.0):
+        self.latency    = latency
+        self.jitter     = jitter
+        self.error_rate = error_rate
+        self.slow_rate  = slow_rate
+        self.corpus     = corpus or load_corpus()
+        self.calls      = 0
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                api.calls += 1
+                delay = max(0.0, random.gauss(api.latency, api.jitter))
+                if random.random() < api.slow_rate:
+                    delay *= 5
+                if random.random() < api.error_rate:
+                    time.sleep(delay / 2)
+                    self._send(random.choice([502, 503, 504]), b'{"error": "fake upstream failure"}')
+                    return
+                text = random.choice(api.corpus)
+                if body.get("stream"):
+                    self._stream(text, delay)
+                    return
+                time.sleep(delay)
+                self._send(200, json.dumps({"output": [{"type": "text", "text": text}]}).encode())
+
+            def _send(self, status, payload):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _stream(self, text, delay):
+                lines = text.splitlines(keepends=True)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for line in lines:
+                    time.sleep(delay / max(len(lines), 1))
+                    self.wfile.write(f"data: {json.dumps({'delta': line})}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+        super().__init__(_HangupTolerantServer(("127.0.0.1", 0), Handler))
+
+
+# ─────────────────────────────────────────────
+# SMTP
+# ─────────────────────────────────────────────
+class SMTPSink(_Server):
+    """Records (timestamp, recipients, raw message) for every mail."""
+
+    def __init__(self):
+        self.messages = []
+        self._lock    = threading.Lock()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write((line + "\r\n").encode())
+                self.wfile.flush()
+
+            def handle(self):
+                self.reply("220 smtp-sink ready")
+                recipients, data = [], None
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    if data is not None:
+                        if line in (b".\r\n", b".\n"):
+                            with sink._lock:
+                                sink.messages.append((time.time(), recipients, b"".join(data)))
+                            recipients, data = [], None
+                            self.reply("250 queued")
+                        else:
+                            data.append(line[1:] if line.startswith(b"..") else line)
+                        continue
+                    cmd = line.decode(errors="replace").strip()
+                    verb = cmd[:4].upper()
+                    if verb in ("EHLO", "HELO"):
+                        self.reply("250 smtp-sink")
+                    elif verb == "RCPT":
+                        recipients.append(cmd.split(":", 1)[1].strip(" <>"))
+                        self.reply("250 ok")
+                    elif verb == "DATA":
+                        data = []
+                        self.reply("354 end with .")
+                    elif verb == "QUIT":
+                        self.reply("221 bye")
+                        return
+                    else:
+                        self.reply("250 ok")
+
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        super().__init__(server)
+
+    def delivered_at(self):
+        """Map recipient -> time their first message arrived."""
+        with self._lock:
+            out = {}
+            for ts, recipients, _ in self.messages:
+                for r in recipients:
+                    out.setdefault(r, ts)
+            return out
+
+
+# ─────────────────────────────────────────────
+# CALENDAR
+# ─────────────────────────────────────────────
+class FakeCalendar(_Server):
+    """In-memory Calendar v3 endpoint. Point CALENDAR_API_ENDPOINT at .url."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.events  = []
+        self._lock   = threading.Lock()
+        cal = self
+
+        def handle_call(method, path, body):
+            path = path.split("?", 1)[0]
+            if path.endswith("/freeBusy"):
+                return 200, {"calendars": {"primary": {"busy": []}}}
+            if path.endswith("/events") and method == "GET":
+                return 200, {"items": []}
+            if path.endswith("/events") and method == "POST":
+                with cal._lock:
+                    event = dict(body, id=f"evt{len(cal.events) + 1}")
+                    cal.events.append(event)
+                return 200, event
+            if "/events/" in path and method in ("PATCH", "PUT"):
+                return 200, dict(body, id=path.rsplit("/", 1)[1])
+            return 404, {"error": {"code": 404, "message": f"no route for {method} {path}"}}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _send(self, status, payload, content_type="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _handle(self):
+                time.sleep(cal.latency)
+                raw = self._body()
+                if self.path.startswith("/batch"):
+                    self._batch(raw)
+                    return
+                status, payload = handle_call(self.command, self.path, json.loads(raw or b"{}"))
+                self._send(status, json.dumps(payload).encode())
+
+            def _batch(self, raw):
+                envelope = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + raw
+                message  = BytesParser(policy=HTTP).parsebytes(envelope)
+                boundary = "batch_fake_calendar"
+                out = []
+                for part in message.iter_parts():
+                    inner = part.get_payload(decode=True) or part.get_payload().encode()
+                    head, _, body = inner.partition(b"\r\n\r\n")
+                    method, path, _ = head.split(b"\r\n", 1)[0].decode().split(" ", 2)
+                    status, payload = handle_call(method, path, json.loads(body or b"{}"))
+                    content_id = part["Content-ID"].strip("<>")
+                    out.append(
+                        f"--{boundary}\r\nContent-Type: application/http\r\n"
+                        f"Content-ID: <response-{content_id}>\r\n\r\n"
+                        f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n"
+                        f"{json.dumps(payload)}\r\n"
+                    )
+                out.append(f"--{boundary}--\r\n")
+                self._send(200, "".join(out).encode(), f"multipart/mixed; boundary={boundary}")
+
+            do_GET = do_POST = do_PATCH = do_PUT = _handle
+
+        super().__init__(ThreadingHTTPServer(("127.0.0.1", 0), Handler))
+
+    @staticmethod
+    def write_token(path):
+        """A token.json that won't need refreshing during a test run."""
+        with open(path, "w") as f:
+            json.dump({
+                "token": "fake-access-token",
+                "refresh_token": "fake-refresh-token",
+                "client_id": "fake-client",
+                "client_secret": "fake-secret",
+                "token_uri": "http://127.0.0.1:9/token",
+                "scopes": ["https://www.googleapis.com/auth/calendar"],
+                "expiry": "2099-01-01T00:00:00Z",
+            }, f)
+
+
+# ─────────────────────────────────────────────
+# GEOCODING
+# ─────────────────────────────────────────────
+class FakeGeocodeBackend:
+    """Resolves only the last address component (the city) to fixed places."""
+
+    PLACES = {
+        "meknes": (33.8950, -5.5547, 531),
+        "fes":    (34.0331, -5.0003, 414),
+        "ifrane": (33.5228, -5.1106, 1665),
+        "agadir": (30.4278, -9.5981, 74),
+    }
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+
+    def search(self, query):
+        time.sleep(self.latency)
+        if "," in query:
+            return None
+        place = self.PLACES.get(query.strip().lower())
+        if place is None:
+            return None
+        return {
+            "lat": str(place[0]), "lon": str(place[1]),
+            "display_name": f"{query.strip()}, Morocco",
+            "address": {"state": "Fake Region", "country": "Morocco"},
+        }
+
+    def elevation(self, lat, lon):
+        time.sleep(self.latency)
+        for plat, plon, metres in self.PLACES.values():
+            if abs(plat - float(lat)) < 0.01 and abs(plon - float(lon)) < 0.01:
+                return metres
+        return None
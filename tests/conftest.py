@@ -0,0 +1,20 @@
+"""Point server.py's on-disk state at a scratch directory before it is imported."""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = tempfile.mkdtemp(prefix="crop-tests-")
+
+os.environ.update(
+    NOTIFY_WORKERS="0",
+    NOTIFY_QUEUE_PATH=os.path.join(STATE_DIR, "notifications.db"),
+    HISTORY_PATH=os.path.join(STATE_DIR, "advisory_history.db"),
+    JOBS_PATH=os.path.join(STATE_DIR, "advisory_jobs.db"),
+    GEOCODE_CACHE_PATH=os.path.join(STATE_DIR, "geocode.db"),
+    CALENDAR_INDEX_PATH=os.path.join(STATE_DIR, "calendar_events.db"),
+    CALENDAR_TOKEN_PATH=os.path.join(STATE_DIR, "token.json"),
+    TRACE_PATH="",
+    TRACE_SLOW_PATH=os.path.join(STATE_DIR, "slow_requests.jsonl"),
+)
+sys.path.insert(0, ROOT)
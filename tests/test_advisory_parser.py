@@ -0,0 +1,162 @@
+"""parse_advisory() must read agent output exactly as the line scanners it replaced did.
+
+The reference functions below are the pre-parser extraction code, kept
+verbatim minus the HTML building, and are compared field by field on a
+seeded random corpus plus the benchmark advisories.
+"""
+import os
+import random
+import re
+
+import pytest
+
+import server
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "..", "benchmarks", "corpus")
+
+
+def baseline_extract_actions(response_text):
+    actions = []
+    for urgency, pattern in [
+        ("URGENT", r'\[URGENT\][:\s]+(.+?)(?:\n|$)'),
+        ("MEDIUM", r'\[MEDIUM\][:\s]+(.+?)(?:\n|$)'),
+        ("LOW",    r'\[LOW\][:\s]+(.+?)(?:\n|$)'),
+    ]:
+        for a in re.findall(pattern, response_text):
+            actions.append({"title": a.strip()[:80], "urgency": urgency, "description": a.strip()})
+    if not actions:
+        actions.append({
+            "title": "Review crop protection plan",
+            "urgency": "MEDIUM",
+            "description": "Review and apply the crop protection recommendations from your AI advisor."
+        })
+    return actions[:8]
+
+
+def baseline_fields(text):
+    weather = "N/A"
+    for line in text.split("\n"):
+        if "🌡️" in line or "WEATHER:" in line:
+            weather = line.replace("🌡️", "").replace("WEATHER:", "").strip()
+            break
+
+    threat_level = "MEDIUM"
+    for line in text.split("\n"):
+        if "THREAT LEVEL" in line or "⚠️" in line:
+            up = line.upper()
+            if "CRITICAL" in up:
+                threat_level = "CRITICAL"
+            elif "HIGH" in up:
+                threat_level = "HIGH"
+            elif "LOW" in up:
+                threat_level = "LOW"
+            break
+
+    threat_why = ""
+    for line in text.split("\n"):
+        if "💬" in line or "WHY:" in line:
+            threat_why = line.replace("💬", "").replace("WHY:", "").strip()
+            break
+
+    threats, in_threats = [], False
+    for line in text.split("\n"):
+        if "ACTIVE THREATS" in line or "🔴" in line:
+            in_threats = True; continue
+        if in_threats:
+            if line.strip().startswith("- "):
+                threats.append(line.strip()[2:])
+            elif line.strip() == "" or any(x in line for x in ["✅","💧","📧","📅","IMMEDIATE","IRRIGATION"]):
+                break
+
+    actions, in_actions = [], False
+    for line in text.split("\n"):
+        if "IMMEDIATE ACTIONS" in line or "✅" in line:
+            in_actions = True; continue
+        if in_actions:
+            if line.strip().startswith("- "):
+                actions.append(line.strip()[2:])
+            elif line.strip() == "" or any(x in line for x in ["💧","📧","📅","IRRIGATION"]):
+                break
+
+    irrigation = ""
+    for line in text.split("\n"):
+        if "💧" in line or "IRRIGATION:" in line:
+            irrigation = line.replace("💧","").replace("IRRIGATION:","").strip()
+            break
+
+    parsed_threats = []
+    for t in threats:
+        risk = ""
+        for lv in ("CRITICAL", "HIGH", "MEDIUM", "LOW"):
+            if f"— {lv}" in t.upper() or f"- {lv}" in t.upper():
+                risk = lv; break
+        clean = re.sub(r'\s*[—\-]\s*(CRITICAL|HIGH|MEDIUM|LOW)\s*:?', ':', t, flags=re.IGNORECASE).strip()
+        parts = clean.split(":", 1)
+        parsed_threats.append((parts[0].strip(), parts[1].strip() if len(parts) > 1 else "", risk))
+
+    parsed_actions = []
+    for a in actions:
+        tag = ""
+        for key in ("URGENT", "MEDIUM", "LOW"):
+            if f"[{key}]" in a:
+                tag = key
+                a = a.replace(f"[{key}]", "").strip(); break
+        parsed_actions.append((a, tag))
+
+    return weather, threat_level, threat_why, parsed_threats, parsed_actions, irrigation
+
+
+def parsed_fields(text):
+    advisory = server._parse_advisory(text)
+    return (advisory.weather, advisory.threat_level, advisory.why,
+            [(t.name, t.reason, t.risk) for t in advisory.threats],
+            [(a.text, a.urgency) for a in advisory.actions],
+            advisory.irrigation)
+
+
+FRAGMENTS = [
+    "🌡️", "WEATHER:", "THREAT LEVEL:", "⚠️", "CRITICAL", "HIGH", "MEDIUM", "LOW", "critical", "high",
+    "💬", "WHY:", "🔴", "ACTIVE THREATS", "✅", "IMMEDIATE ACTIONS", "IMMEDIATE", "💧", "IRRIGATION:",
+    "IRRIGATION", "📧", "📅", "[URGENT]", "[MEDIUM]", "[LOW]", "[URGENT]:", "[", "]", ":", " ", "  ", "\t",
+    " — ", " - ", "—", "-", "Late blight", "Aphids", "spray copper", "within 24 hours", "28°C, humid",
+]
+
+
+def random_advisory(rng):
+    lines = []
+    for _ in range(rng.randint(0, 25)):
+        roll = rng.random()
+        if roll < 0.12:
+            lines.append(rng.choice(["", " ", "\t"]))
+            continue
+        line = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 6)))
+        if roll < 0.45:
+            line = rng.choice(["- ", "  - ", "-  ", "-"]) + line
+        lines.append(line)
+    return "\n".join(lines) + rng.choice(["", "\n", "\n\n"])
+
+
+def corpus():
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        with open(os.path.join(CORPUS_DIR, name), encoding="utf-8") as f:
+            yield f.read()
+
+
+@pytest.mark.parametrize("text", list(corpus()))
+def test_benchmark_corpus_matches_baseline(text):
+    assert parsed_fields(text) == baseline_fields(text)
+    assert server.extract_actions(text) == baseline_extract_actions(text)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_advisories_match_baseline(seed):
+    rng = random.Random(seed)
+    for _ in range(1000):
+        text = random_advisory(rng)
+        assert parsed_fields(text) == baseline_fields(text), text
+        assert server.extract_actions(text) == baseline_extract_actions(text), text
+
+
+def test_parse_is_memoized():
+    text = "THREAT LEVEL: HIGH\n✅ IMMEDIATE ACTIONS\n- [URGENT] Spray copper today\n"
+    assert server.parse_advisory(text) is server.parse_advisory(text)
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import server
+from conftest import STATE_DIR
+from server import GeocodeError, Geocoder, NominatimBackend, OutboundGuard
+
+MATCH = [{"lat": "33.8935", "lon": "-5.5473", "display_name": "Meknes, Morocco", "address": {"state": "Fes-Meknes"}}]
+
+
+class StandIn:
+    """A local Nominatim: answers each search with the status and body set on it."""
+
+    def __init__(self):
+        self.status, self.body, self.searches = 200, MATCH, []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith("/search"):
+                    stand_in.searches.append(self.path)
+                    time.sleep(0.05)
+                    status, body = stand_in.status, json.dumps(stand_in.body).encode()
+                else:
+                    status, body = 200, b'{"results": [{"elevation": 531}]}'
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+
+@pytest.fixture
+def nominatim(monkeypatch):
+    monkeypatch.setitem(server.guards, "geocode", OutboundGuard("geocode", 0, 1, 1, 0, 0, 100, 30, 1))
+    stand_in = StandIn()
+    yield stand_in
+    stand_in.server.shutdown()
+
+
+@pytest.fixture
+def geocoder(nominatim, monkeypatch, request):
+    path = os.path.join(STATE_DIR, f"geocode-{request.node.name}.db")
+    geocoder = Geocoder(NominatimBackend(nominatim.url + "/search", nominatim.url + "/elevation"),
+                        path, 3600, 3600, 4)
+    monkeypatch.setattr(server, "geocoder", geocoder)
+    return geocoder
+
+
+def cached_rows(geocoder):
+    return geocoder._db.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+
+
+def test_match_is_cached(geocoder, nominatim):
+    first = geocoder.resolve("", "Meknes")
+    assert first["lat"] == "33.8935" and first["elevation"] == 531
+    assert geocoder.resolve("", "Meknes") == first
+    assert len(nominatim.searches) == 1
+
+
+def test_empty_answer_is_cached_as_a_miss(geocoder, nominatim):
+    nominatim.body = []
+    assert geocoder.resolve("", "Nowhere") is None
+    assert geocoder.resolve("", "Nowhere") is None
+    assert len(nominatim.searches) == 1
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_backend_error_is_not_cached(geocoder, nominatim, status):
+    nominatim.status = status
+    with pytest.raises(GeocodeError):
+        geocoder.resolve("", "Meknes")
+    assert cached_rows(geocoder) == 0
+
+    nominatim.status = 200
+    assert geocoder.resolve("", "Meknes")["lat"] == "33.8935"
+
+
+def test_unreachable_backend_answers_502(geocoder, nominatim):
+    nominatim.server.shutdown()
+    nominatim.server.server_close()
+    res = server.app.test_client().get("/geocode?city=Meknes")
+    assert res.status_code == 502
+    assert cached_rows(geocoder) == 0
+
+
+def test_concurrent_lookups_share_one_search(geocoder, nominatim):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(geocoder.resolve("", "Meknes")))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(nominatim.searches) == 1
+    assert len(results) == 8 and all(r == results[0] for r in results)
+
+
+def test_async_server_hands_geocode_to_flask(geocoder, nominatim, monkeypatch):
+    monkeypatch.setattr(server.advisory_jobs, "listeners", [])
+
+    async def scenario():
+        app = server.AsyncInvokeApp(4)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            found = await client.get("/geocode", params={"city": "Meknes"})
+            missing = await client.get("/geocode")
+        await app._client.aclose()
+        return found, missing
+
+    found, missing = asyncio.run(scenario())
+    assert found.status_code == 200 and found.json()["lat"] == "33.8935"
+    assert missing.status_code == 400
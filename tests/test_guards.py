@@ -0,0 +1,129 @@
+import asyncio
+
+import httpx
+import pytest
+
+import server
+from server import CircuitBreaker, CircuitOpen, OutboundGuard
+
+
+def make_guard(monkeypatch=None, attempts=1):
+    guard = OutboundGuard("test", 0, 1, attempts, 0, 0, 1, 0.05, 1)
+    if monkeypatch:
+        monkeypatch.setitem(server.guards, "agent", guard)
+    return guard
+
+
+def half_open(guard):
+    with pytest.raises(OSError):
+        guard.call(lambda: (_ for _ in ()).throw(OSError("down")), retry_on=(OSError,))
+    assert guard.breaker.state == CircuitBreaker.OPEN
+    asyncio.run(asyncio.sleep(0.06))
+
+
+def test_half_open_lets_one_probe_through():
+    guard = make_guard()
+    half_open(guard)
+    assert guard.breaker.allow()
+    assert not guard.breaker.allow()
+    guard.succeeded()
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_interrupted_probe_gives_its_slot_back():
+    guard = make_guard()
+    half_open(guard)
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        guard.call(interrupted, retry_on=(OSError,))
+    assert guard.breaker.state == CircuitBreaker.HALF_OPEN
+    assert guard.call(lambda: "ok") == "ok"
+    assert guard.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_async_probe_gives_its_slot_back():
+    guard = make_guard()
+    half_open(guard)
+
+    async def scenario():
+        probe = asyncio.create_task(guard.acall(lambda: asyncio.sleep(10), retry_on=(OSError,)))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def ok():
+            return "ok"
+        return await guard.acall(ok)
+
+    assert asyncio.run(scenario()) == "ok"
+
+
+def test_cancelled_stream_probe_gives_its_slot_back(monkeypatch):
+    guard = make_guard(monkeypatch)
+    half_open(guard)
+
+    class HangingRouter:
+        async def acall(self, fn, **kwargs):
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(server, "agent_router", HangingRouter())
+    app = server.AsyncInvokeApp(1)
+    app._httpx = httpx
+
+    async def send(message):
+        pass
+
+    async def scenario():
+        stream = asyncio.create_task(app._invoke_stream(send, {}, {}, "", False, "key"))
+        await asyncio.sleep(0.01)
+        stream.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await stream
+
+    asyncio.run(scenario())
+    assert guard.breaker.allow()
+
+
+def test_open_breaker_refuses_without_calling():
+    guard = make_guard()
+    with pytest.raises(OSError):
+        guard.call(lambda: (_ for _ in ()).throw(OSError("down")), retry_on=(OSError,))
+    calls = []
+    with pytest.raises(CircuitOpen):
+        guard.call(lambda: calls.append(1))
+    assert calls == []
+
+
+def test_batch_retries_are_charged_for_the_calls_they_resend(monkeypatch):
+    guard = OutboundGuard("calendar", 0, 1, 4, 0, 0, 100, 30, 1)
+    monkeypatch.setitem(server.guards, "calendar", guard)
+    charged = []
+    admit = guard.admit
+    monkeypatch.setattr(guard, "admit", lambda tokens=1: charged.append(tokens) or admit(tokens))
+
+    class Unavailable(Exception):
+        resp = type("Response", (), {"status": 503})()
+
+    class Batch:
+        def __init__(self, callback):
+            self.callback, self.ids = callback, []
+
+        def add(self, request, request_id):
+            self.ids.append(request_id)
+
+        def execute(self):
+            # The first half of every batch fails with a retryable status
+            for i, request_id in enumerate(self.ids):
+                if i < len(self.ids) // 2:
+                    self.callback(request_id, None, Unavailable())
+                else:
+                    self.callback(request_id, {"id": request_id}, None)
+
+    service = type("Service", (), {"new_batch_http_request": lambda self, callback: Batch(callback)})()
+    results, errors = server.run_calendar_batch(service, {str(i): object() for i in range(8)})
+    assert charged == [8, 4, 2, 1]
+    assert len(results) == 8 and not errors
@@ -0,0 +1,66 @@
+import urllib.parse
+
+import pytest
+
+import server
+
+PROMPT = ("Hi, I am Amal, a farmer from Meknes. My farm is located at: Route 5. "
+          "I grow olives. My email is {email}. Use \"Meknes\" for the weather lookup.")
+ADVISORY = "⚠️ THREAT LEVEL: HIGH\n✅ IMMEDIATE ACTIONS:\n- [URGENT] Spray copper fungicide today"
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def record(email):
+    return server.history.record({"to_email": email, "farmer_name": "Amal", "location": "Route 5",
+                                  "crop": "olives", "response_text": ADVISORY}, "Meknes")
+
+
+def link_token(email):
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(server.history_link(email)).query)
+    assert query["history_email"] == [email]
+    return query["history_token"][0]
+
+
+def test_invoke_does_not_hand_out_history_tokens(client, monkeypatch):
+    monkeypatch.setattr(server, "call_agent", lambda data, headers: (200, {"output": ADVISORY}))
+    monkeypatch.setattr(server, "dispatch_notifications", lambda *a, **k: True)
+    res = client.post("/invoke", json={"input": [{"text": PROMPT.format(email="victim@farm.ma")}]})
+    assert res.status_code == 200
+    assert "X-History-Token" not in res.headers
+
+
+def test_history_requires_a_token(client):
+    record("owner@farm.ma")
+    assert client.get("/history?email=owner@farm.ma").status_code == 401
+    res = client.get("/history?email=owner@farm.ma", headers={"X-History-Token": "0" * 32})
+    assert res.status_code == 401
+
+
+def test_emailed_link_opens_only_that_farmers_history(client):
+    mine, theirs = record("mine@farm.ma"), record("theirs@farm.ma")
+    headers = {"X-History-Token": link_token("mine@farm.ma")}
+
+    items = client.get("/history?email=mine@farm.ma", headers=headers).get_json()["items"]
+    assert {i["id"] for i in items} == {mine}
+    assert client.get(f"/history/{mine}?email=mine@farm.ma", headers=headers).status_code == 200
+    assert client.get(f"/history/{theirs}?email=mine@farm.ma", headers=headers).status_code == 404
+    assert client.get("/history?email=theirs@farm.ma", headers=headers).status_code == 401
+
+
+def test_alert_email_carries_the_history_link():
+    url = server.history_link("mine@farm.ma")
+    subject, text, html = server.render_alert_email("Amal", "Route 5", "olives", ADVISORY, [], url)
+    assert url in text
+    assert server.escape(url) in html
+
+
+def test_admin_key_reads_everyone(client, monkeypatch):
+    monkeypatch.setattr(server, "HISTORY_ADMIN_KEY", "ops-key")
+    record("someone@farm.ma")
+    res = client.get("/history", headers={"Authorization": "Bearer ops-key"})
+    assert res.status_code == 200
+    assert any(i["email"] == "someone@farm.ma" for i in res.get_json()["items"])
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+import server
+from conftest import STATE_DIR
+from server import AdvisoryJobs
+
+ADVISORY = "⚠️ THREAT LEVEL: LOW\n✅ IMMEDIATE ACTIONS:\n- [LOW] Keep monitoring"
+
+
+@pytest.fixture
+def make_jobs(request):
+    def make(ttl=3600, stale_after=0.2):
+        return AdvisoryJobs(os.path.join(STATE_DIR, f"jobs-{request.node.name}.db"), ttl, stale_after)
+    return make
+
+
+def test_waiting_job_is_kept_alive_by_its_owner(make_jobs):
+    jobs = make_jobs()
+    job_id = jobs.create()
+    time.sleep(0.5)
+    assert jobs.get(job_id)["state"] == "queued"
+    jobs.start(job_id)
+    time.sleep(0.5)
+    job = jobs.get(job_id)
+    assert job["state"] == "running" and job["started_at"]
+
+
+def test_job_of_a_vanished_process_is_abandoned(make_jobs):
+    jobs = make_jobs()
+    job_id = jobs.create()
+    jobs._db.execute("UPDATE advisory_jobs SET owner='gone', lease_until=? WHERE id=?",
+                     (time.time() - 1, job_id))
+    job = jobs.get(job_id)
+    assert job["state"] == "failed" and job["status"] == 500
+    assert jobs.stats()["total_abandoned"] == 1
+
+
+def test_finished_jobs_are_purged_whatever_their_outcome(make_jobs):
+    jobs = make_jobs(ttl=0.1)
+    done, failed, waiting = jobs.create(), jobs.create(), jobs.create()
+    jobs.finish(done, 200, {"output": ADVISORY})
+    jobs.finish(failed, 502, {"error": "Upstream API unreachable"}, "Upstream API unreachable")
+    time.sleep(0.3)
+    jobs.sweep()
+    assert jobs.get(done) is None
+    assert jobs.get(failed) is None
+    assert jobs.get(waiting)["state"] == "queued"
+
+
+def agent_answering_after(monkeypatch, gate):
+    def call_agent(data, headers):
+        gate.wait(5)
+        return 200, {"output": ADVISORY}
+    monkeypatch.setattr(server, "call_agent", call_agent)
+    monkeypatch.setattr(server, "dispatch_notifications", lambda *a, **k: True)
+
+
+def test_job_queued_behind_a_slow_one_is_not_abandoned(monkeypatch, make_jobs):
+    gate = threading.Event()
+    agent_answering_after(monkeypatch, gate)
+    monkeypatch.setattr(server, "advisory_jobs", make_jobs(stale_after=0.2))
+    monkeypatch.setattr(server, "job_pool", ThreadPoolExecutor(max_workers=1))
+    client = server.app.test_client()
+
+    first = client.post("/invoke", json={"async": True, "input": [{"text": "jobs test slow"}]}).get_json()
+    second = client.post("/invoke", json={"async": True, "input": [{"text": "jobs test queued"}]}).get_json()
+    time.sleep(0.5)
+    assert client.get(f"/jobs/{second['job_id']}").get_json()["state"] == "queued"
+
+    gate.set()
+    for job in (first, second):
+        done = client.get(f"/jobs/{job['job_id']}?wait=5").get_json()
+        assert done["state"] == "done" and done["result"]["output"] == ADVISORY
+
+
+def test_async_server_runs_jobs(monkeypatch, make_jobs):
+    monkeypatch.setattr(server, "advisory_jobs", make_jobs())
+    monkeypatch.setattr(server, "dispatch_notifications", lambda *a, **k: True)
+
+    async def scenario():
+        app = server.AsyncInvokeApp(4)
+
+        async def fetch(key, data, headers):
+            await asyncio.sleep(0.1)
+            return 200, {"output": ADVISORY}, "MISS"
+        app._fetch = fetch
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            accepted = await client.post("/invoke?async=1", json={"input": [{"text": "jobs test async"}]})
+            done = await client.get(accepted.headers["location"], params={"wait": 5})
+            missing = await client.get("/jobs/unknown")
+        await app._client.aclose()
+        return accepted, done, missing
+
+    accepted, done, missing = asyncio.run(scenario())
+    assert accepted.status_code == 202
+    assert done.json()["state"] == "done" and done.json()["result"]["output"] == ADVISORY
+    assert missing.status_code == 404
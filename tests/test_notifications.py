@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+
+import pytest
+
+import server
+from conftest import STATE_DIR
+from server import NotificationQueue
+
+WINDOW = 0.4
+ADVISORY = "⚠️ THREAT LEVEL: HIGH\n✅ IMMEDIATE ACTIONS:\n- [URGENT] Spray copper fungicide today"
+
+
+class Outbox:
+    """Stands in for SMTP: records each alert and digest with the time it went out."""
+
+    def __init__(self, monkeypatch):
+        self.sent, self.fail_digests = [], 0
+        self.changed = threading.Condition()
+        monkeypatch.setattr(server.calendar, "is_configured", lambda: False)
+        monkeypatch.setattr(server, "send_email", self.alert)
+        monkeypatch.setattr(server, "send_digest_email", self.digest)
+
+    def _record(self, kind, crops):
+        with self.changed:
+            self.sent.append((kind, crops, time.monotonic()))
+            self.changed.notify_all()
+
+    def alert(self, to_email, farmer_name, location, crop, response_text, calendar_events):
+        self._record("alert", [crop])
+        return True
+
+    def digest(self, to_email, jobs):
+        if self.fail_digests:
+            self.fail_digests -= 1
+            self._record("failed digest", sorted(j["crop"] for j in jobs))
+            return False
+        self._record("digest", sorted(j["crop"] for j in jobs))
+        return True
+
+    def wait_for(self, count, timeout=5):
+        with self.changed:
+            assert self.changed.wait_for(lambda: len(self.sent) >= count, timeout), self.sent
+        return self.sent[:count]
+
+
+def job(crop, email="amal@farm.ma"):
+    return {"to_email": email, "farmer_name": "Amal", "location": "Route 5", "crop": crop,
+            "response_text": ADVISORY, "submitted_at": time.time()}
+
+
+def drained(q, timeout=5):
+    deadline = time.monotonic() + timeout
+    while q.depth() or q.active():
+        assert time.monotonic() < deadline, q.stats()
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def make_queue(request):
+    queues = []
+
+    def make(window=WINDOW, workers=1, **kwargs):
+        path = os.path.join(STATE_DIR, f"notify-{request.node.name}-{len(queues)}.db")
+        q = NotificationQueue(path, workers, 100, kwargs.pop("max_attempts", 3), kwargs.pop("retry_base", 0.05),
+                              window, kwargs.pop("lease", 30))
+        queues.append(q)
+        return q
+
+    yield make
+    for q in queues:
+        q.shutdown(2)
+
+
+def test_lone_alert_is_mailed_without_waiting(monkeypatch, make_queue):
+    outbox = Outbox(monkeypatch)
+    q = make_queue()
+    queued = time.monotonic()
+    q.enqueue(job("olives"))
+    (kind, crops, at), = outbox.wait_for(1)
+    assert (kind, crops) == ("alert", ["olives"])
+    assert at - queued < WINDOW / 2
+
+
+def test_followers_within_the_window_share_one_digest(monkeypatch, make_queue):
+    outbox = Outbox(monkeypatch)
+    q = make_queue()
+    q.enqueue(job("olives"))
+    first = outbox.wait_for(1)[0]
+    q.enqueue(job("wheat"))
+    q.enqueue(job("barley"))
+    _, (kind, crops, at) = outbox.wait_for(2)
+    assert (kind, crops) == ("digest", ["barley", "wheat"])
+    assert at - first[2] >= WINDOW * 0.9
+    drained(q)
+    assert q.stats()["total_coalesced"] == 1
+
+
+def test_failed_digest_is_retried_as_one_email(monkeypatch, make_queue):
+    outbox = Outbox(monkeypatch)
+    outbox.fail_digests = 1
+    q = make_queue(workers=0)
+    for crop in ("olives", "wheat", "barley"):
+        q.enqueue(job(crop))
+    q.workers = 1
+    q.start()
+    failed, retried = outbox.wait_for(2)
+    assert failed[:2] == ("failed digest", ["barley", "olives", "wheat"])
+    assert retried[:2] == ("digest", ["barley", "olives", "wheat"])
+    drained(q)
+    assert len(outbox.sent) == 2
+
+
+def test_recipients_are_coalesced_separately(monkeypatch, make_queue):
+    outbox = Outbox(monkeypatch)
+    q = make_queue()
+    q.enqueue(job("olives", "a@farm.ma"))
+    q.enqueue(job("wheat", "b@farm.ma"))
+    sent = outbox.wait_for(2)
+    assert sorted((kind, crops[0]) for kind, crops, _ in sent) == [("alert", "olives"), ("alert", "wheat")]
+
+
+def test_window_zero_sends_every_alert(monkeypatch, make_queue):
+    outbox = Outbox(monkeypatch)
+    q = make_queue(window=0)
+    for crop in ("olives", "wheat"):
+        q.enqueue(job(crop))
+    assert [kind for kind, _, _ in outbox.wait_for(2)] == ["alert", "alert"]
+
+
+def test_processes_sharing_the_file_never_claim_the_same_job(make_queue):
+    first = make_queue(window=0, workers=0)
+    second = NotificationQueue(first.path, 0, 100, 3, 1, 0, 30)
+    for i in range(100):
+        first.enqueue(job(f"crop-{i}", f"farmer{i}@farm.ma"))
+    claimed = {first: [], second: []}
+
+    def drain(q):
+        while (group := q._claim()) is not None:
+            claimed[q].extend(job_id for job_id, _, _ in group)
+
+    threads = [threading.Thread(target=drain, args=(q,)) for q in claimed]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    mine, theirs = claimed[first], claimed[second]
+    assert len(mine) + len(theirs) == 100
+    assert not set(mine) & set(theirs)
+
+
+def test_expired_lease_is_reclaimed_and_the_old_owner_loses_it(make_queue):
+    dead = make_queue(window=0, workers=0, lease=0.1)
+    job_id = dead.enqueue(job("olives"))
+    assert [j for j, _, _ in dead._claim()] == [job_id]
+
+    alive = NotificationQueue(dead.path, 0, 100, 3, 1, 0, 0.1)
+    assert alive._claim() is None          # still leased
+    time.sleep(0.15)
+    assert [j for j, _, _ in alive._claim()] == [job_id]
+    assert alive.stats()["total_reclaimed"] == 1
+
+    dead._finish(job_id)                   # too late: the job is no longer this owner's
+    assert alive.depth() == 1
+    alive._finish(job_id)
+    assert alive.depth() == 0
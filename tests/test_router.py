@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import server
+from server import CircuitBreaker, CircuitOpen, OutboundGuard, UpstreamRouter
+
+A, B = "http://agent-a", "http://agent-b"
+
+
+class Response:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.text = ""
+        self._body = body or {"output": "ok"}
+
+    def json(self):
+        return self._body
+
+
+def make_router(hedge=False, reset=30.0):
+    router = UpstreamRouter([A, B], hedge, 0.95, 0.05, 0.01, 50)
+    for endpoint in router.endpoints:
+        endpoint.breaker.failure_threshold = 1
+        endpoint.breaker.reset_timeout = reset
+    return router
+
+
+def trip_all(router):
+    for endpoint in router.endpoints:
+        endpoint.breaker.failure()
+        assert endpoint.breaker.state == CircuitBreaker.OPEN
+
+
+def test_prefers_the_faster_endpoint():
+    router = make_router()
+    router.endpoints[0].samples["post"].extend([0.9] * 5)
+    router.endpoints[1].samples["post"].extend([0.1] * 5)
+    sent = []
+    router.call(lambda url: sent.append(url) or Response())
+    assert sent == [B]
+
+
+def test_tripped_endpoint_is_skipped():
+    router = make_router()
+    router.endpoints[0].breaker.failure()
+    sent = []
+    for _ in range(3):
+        router.call(lambda url: sent.append(url) or Response())
+    assert sent == [B, B, B]
+
+
+def test_all_tripped_sends_nothing():
+    router = make_router()
+    trip_all(router)
+    sent = []
+    with pytest.raises(CircuitOpen) as refused:
+        router.call(lambda url: sent.append(url) or Response())
+    assert sent == []
+    assert refused.value.retry_after > 0
+
+
+def test_half_open_sends_a_single_probe():
+    router = make_router(reset=0.05)
+    trip_all(router)
+    time.sleep(0.06)
+    release = threading.Event()
+    sent = []
+
+    def slow(url):
+        sent.append(url)
+        release.wait(1)
+        return Response()
+
+    probes = [threading.Thread(target=router.call, args=(slow,)) for _ in range(2)]
+    for t in probes:
+        t.start()
+    time.sleep(0.05)
+    # Both endpoints are probing; a third caller is refused rather than piling on
+    with pytest.raises(CircuitOpen):
+        router.call(lambda url: sent.append(url) or Response())
+    release.set()
+    for t in probes:
+        t.join()
+    assert sorted(sent) == [A, B]
+    assert all(e.breaker.state == CircuitBreaker.CLOSED for e in router.endpoints)
+
+
+def test_invoke_answers_503_with_retry_after_when_every_endpoint_is_down(monkeypatch):
+    router = make_router()
+    trip_all(router)
+    monkeypatch.setattr(server, "agent_router", router)
+    monkeypatch.setitem(server.guards, "agent", OutboundGuard("agent", 0, 1, 3, 0, 0, 5, 30, 1))
+    res = server.app.test_client().post("/invoke", json={"input": [{"text": "router test 503"}]})
+    assert res.status_code == 503
+    assert int(res.headers["Retry-After"]) > 0
+    # A refusal further down is not an outcome for the outer breaker
+    assert server.guards["agent"].breaker.state == CircuitBreaker.CLOSED
+    assert server.guards["agent"].stats()["retries"] == 0
+
+
+def test_slow_primary_is_hedged():
+    router = make_router(hedge=True)
+    closed = []
+
+    def send(url):
+        time.sleep(0.5 if url == A else 0.01)
+        return Response(body={"from": url})
+
+    router.endpoints[1].in_flight = 1    # rank A first
+    winner = router.call(send, discard=lambda r: closed.append(r.json()["from"]))
+    assert winner.json() == {"from": B}
+    assert router.endpoints[1].counters["hedges_won"] == 1
+    time.sleep(0.6)
+    assert closed == [A]
+
+
+def test_async_hedge_loser_is_cancelled_without_keeping_its_probe():
+    router = make_router(hedge=True, reset=0.05)
+    trip_all(router)
+    time.sleep(0.06)
+
+    async def send(url):
+        await asyncio.sleep(1 if url == A else 0.01)
+        return Response(body={"from": url})
+
+    router.endpoints[1].in_flight = 1    # rank A first
+    winner = asyncio.run(router.acall(send))
+    router.endpoints[1].in_flight = 0
+    assert winner.json() == {"from": B}
+    loser = router.endpoints[0]
+    assert loser.in_flight == 0
+    assert loser.breaker.state == CircuitBreaker.HALF_OPEN
+    assert loser.breaker.allow()
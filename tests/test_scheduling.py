@@ -0,0 +1,227 @@
+import random
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from server import SlotAllocator, smart_schedule
+
+MONDAY_8AM = datetime(2026, 10, 19, 8, 0)
+
+
+def hours(start, n):
+    return start, start + timedelta(hours=n)
+
+
+def test_reserve_books_requested_start_when_free():
+    slots = SlotAllocator()
+    start = MONDAY_8AM.replace(hour=10)
+    assert slots.reserve(start, 2) == start
+
+
+def test_reserve_skips_past_long_events():
+    slots = SlotAllocator()
+    harvest = slots.reserve(MONDAY_8AM.replace(hour=10), 4)
+    inspect = slots.reserve(MONDAY_8AM.replace(hour=11), 1)
+    assert inspect == harvest + timedelta(hours=4)
+
+
+def test_reserve_needs_a_gap_for_the_whole_duration():
+    slots = SlotAllocator(busy=[hours(MONDAY_8AM.replace(hour=12), 1)])
+    # 10:00-12:00 fits exactly; 11:00 would run into the 12:00 appointment
+    assert slots.reserve(MONDAY_8AM.replace(hour=10), 2) == MONDAY_8AM.replace(hour=10)
+    assert slots.reserve(MONDAY_8AM.replace(hour=11), 2) == MONDAY_8AM.replace(hour=13)
+
+
+def test_busy_intervals_are_merged():
+    slots = SlotAllocator(busy=[hours(MONDAY_8AM.replace(hour=10), 2), hours(MONDAY_8AM.replace(hour=11), 2),
+                                hours(MONDAY_8AM.replace(hour=13), 1)])
+    assert slots.reserve(MONDAY_8AM.replace(hour=10), 1) == MONDAY_8AM.replace(hour=14)
+
+
+def test_bump_past_last_hour_moves_to_next_morning():
+    slots = SlotAllocator(busy=[hours(MONDAY_8AM.replace(hour=20), 2)])
+    assert slots.reserve(MONDAY_8AM.replace(hour=21), 1) == MONDAY_8AM.replace(hour=9) + timedelta(days=1)
+
+
+def test_busy_block_ending_at_midnight_lands_in_working_hours():
+    # A whole-day freebusy block: the next free hour is 00:00, which is before FIRST_HOUR
+    slots = SlotAllocator(busy=[(datetime(2026, 10, 19), datetime(2026, 10, 20))])
+    assert slots.reserve(datetime(2026, 10, 19, 9), 2) == datetime(2026, 10, 20, 9)
+
+
+def test_event_running_past_midnight_pushes_next_task_to_first_hour():
+    # "harvest in 13 hours" at 08:00 books 21:00-01:00; the next clash must not land at 01:00
+    slots = SlotAllocator()
+    harvest, duration, _ = smart_schedule("Harvest ripe fruit in 13 hours", "URGENT", MONDAY_8AM, slots)
+    assert (harvest, duration) == (MONDAY_8AM.replace(hour=21), 4)
+    inspect, _, _ = smart_schedule("Inspect the storage shed in 13 hours", "URGENT", MONDAY_8AM, slots)
+    assert inspect == MONDAY_8AM.replace(hour=9) + timedelta(days=1)
+
+
+def test_whole_day_freebusy_block_schedules_next_morning():
+    now = datetime(2026, 10, 18, 20, 0)
+    slots = SlotAllocator(busy=[(datetime(2026, 10, 19), datetime(2026, 10, 20))])
+    start, duration, _ = smart_schedule("Spray fungicide tomorrow", "MEDIUM", now, slots)
+    assert (start, duration) == (datetime(2026, 10, 20, 9), 2)
+
+
+@pytest.mark.parametrize("now", [MONDAY_8AM, datetime(2026, 10, 19, 21, 40), datetime(2026, 10, 19, 3, 15)])
+def test_bumped_events_never_overlap_and_stay_in_working_hours(now):
+    slots = SlotAllocator(busy=[hours(now.replace(minute=0) + timedelta(days=1), 24)])
+    booked = []
+    for text in ["Harvest the ripe olives today", "Spray fungicide today", "Inspect traps today",
+                 "Drain the lower field today", "Scout for aphids tomorrow", "Apply copper tomorrow"] * 3:
+        preferred, _, _ = server.preferred_start(text, "URGENT", now)
+        start, duration, _ = smart_schedule(text, "URGENT", now, slots)
+        booked.append((start, start + timedelta(hours=duration)))
+        if start != preferred:
+            assert SlotAllocator.FIRST_HOUR <= start.hour <= SlotAllocator.LAST_HOUR
+    booked.sort()
+    for (_, end), (next_start, _) in zip(booked, booked[1:]):
+        assert end <= next_start
+
+
+def test_classifier_tables_are_memoized():
+    server.classify_action.cache_clear()
+    server.classify_action("spray fungicide tomorrow")
+    server.classify_action("spray fungicide tomorrow")
+    assert server.classify_action.cache_info().hits == 1
+
+
+def baseline_smart_schedule(action_text, urgency, now, used_slots):
+    """The any()-chain scheduler that classify_action() replaced, verbatim."""
+    text = action_text.lower()
+    recurrence = None
+    day_offset = None
+    hour = None
+
+    m = re.search(r'(?:within|in|after)\s+(\d+)\s*h(?:our)?', text)
+    if m:
+        h = int(m.group(1))
+        candidate = now + timedelta(hours=h)
+        day_offset = (candidate.date() - now.date()).days
+        hour = candidate.hour
+
+    if day_offset is None:
+        m = re.search(r'(?:within|in|after)\s+(\d+)\s*day', text)
+        if m:
+            day_offset = int(m.group(1))
+
+    if day_offset is None:
+        if any(w in text for w in ["immediately", "asap", "right away", "straight away", "urgently", "now", "today"]):
+            day_offset = 0
+        elif any(w in text for w in ["tomorrow", "next morning", "first thing"]):
+            day_offset = 1
+        elif any(w in text for w in ["48 hour", "48h", "two day"]):
+            day_offset = 2
+        elif any(w in text for w in ["72 hour", "72h", "three day"]):
+            day_offset = 3
+        elif any(w in text for w in ["next week", "7 day", "one week"]):
+            day_offset = 7
+        elif any(w in text for w in ["10 day", "ten day"]):
+            day_offset = 10
+        elif any(w in text for w in ["fortnight", "14 day", "two week"]):
+            day_offset = 14
+
+    if day_offset is None:
+        if urgency == "URGENT":
+            day_offset = 0
+        elif urgency == "MEDIUM":
+            day_offset = 2
+        else:
+            day_offset = 5
+
+    if hour is None:
+        if any(w in text for w in ["morning", "early", "sunrise", "first light", "dawn"]):
+            hour = 7
+        elif any(w in text for w in ["evening", "dusk", "night", "sunset"]):
+            hour = 18
+        elif any(w in text for w in ["afternoon", "noon", "midday"]):
+            hour = 13
+        elif urgency == "URGENT":
+            hour = 9
+        elif urgency == "MEDIUM":
+            hour = 10
+        else:
+            hour = 11
+
+    candidate = now.replace(minute=0, second=0, microsecond=0)
+    candidate = candidate.replace(hour=min(hour, 22)) + timedelta(days=day_offset)
+    earliest = now + timedelta(minutes=30)
+    if candidate < earliest:
+        candidate = (earliest + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+
+    day_offset = (candidate.date() - now.date()).days
+    hour = candidate.hour
+
+    slot_hour = hour
+    bump = 0
+    while (day_offset, slot_hour) in used_slots:
+        slot_hour += 1
+        if slot_hour > 21:
+            slot_hour = 9
+            day_offset += 1
+        bump += 1
+        if bump > 48:
+            break
+    used_slots.add((day_offset, slot_hour))
+
+    start = now.replace(hour=slot_hour, minute=0, second=0, microsecond=0) + timedelta(days=day_offset)
+    if start < now:
+        start = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+
+    if any(w in text for w in ["scout", "inspect", "check", "monitor", "survey", "assess", "evaluate"]):
+        duration = 1
+    elif any(w in text for w in ["spray", "apply", "treat", "fungicide", "pesticide", "herbicide"]):
+        duration = 2
+    elif any(w in text for w in ["drain", "pump", "clear drain", "remove water", "irrigat"]):
+        duration = 2
+    elif any(w in text for w in ["harvest", "collect", "pick", "thresh"]):
+        duration = 4
+    else:
+        duration = 1
+
+    if any(w in text for w in ["daily", "every day", "each day", "every morning"]):
+        recurrence = ["RRULE:FREQ=DAILY;COUNT=21"]
+    elif any(w in text for w in ["every week", "each week", "weekly"]):
+        recurrence = ["RRULE:FREQ=WEEKLY;COUNT=4"]
+    elif any(w in text for w in ["every 2 day", "every other day", "twice a week", "every 48"]):
+        recurrence = ["RRULE:FREQ=DAILY;INTERVAL=2;COUNT=14"]
+    elif any(w in text for w in ["every 3 day", "every 72"]):
+        recurrence = ["RRULE:FREQ=DAILY;INTERVAL=3;COUNT=10"]
+
+    return start, duration, recurrence
+
+
+KEYWORDS = sorted({w for table in (server.DAY_OFFSET_WORDS, server.TIME_OF_DAY_WORDS,
+                                   server.DURATION_WORDS, server.RECURRENCE_WORDS)
+                   for _, words in table for w in words})
+FILLER = ["the", "field", "rows", "olive", "blight", "copper", "within", "in", "after", "every",
+          "hours", "hour", "h", "days", "day", "and", ",", ".", "MORNING", "Spray"]
+
+
+def random_action(rng):
+    words = []
+    for _ in range(rng.randint(1, 10)):
+        roll = rng.random()
+        if roll < 0.4:
+            words.append(rng.choice(KEYWORDS))
+        elif roll < 0.6:
+            words.append(f"{rng.choice(['within', 'in', 'after', 'IN'])} {rng.randint(0, 400)}"
+                         f"{rng.choice(['', ' '])}{rng.choice(['h', 'hours', 'hour', 'day', 'days', 'd'])}")
+        else:
+            words.append(rng.choice(FILLER))
+    return rng.choice([" ", "", "  "]).join(words)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_classifier_matches_baseline_scheduler(seed):
+    rng = random.Random(seed)
+    for _ in range(1000):
+        text    = random_action(rng)
+        urgency = rng.choice(["URGENT", "MEDIUM", "LOW", "OTHER"])
+        now     = datetime(2026, 10, 19) + timedelta(minutes=rng.randint(0, 7 * 24 * 60))
+        expected = baseline_smart_schedule(text, urgency, now, set())
+        assert smart_schedule(text, urgency, now, SlotAllocator()) == expected, (text, urgency, now)